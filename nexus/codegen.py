@@ -1,43 +1,94 @@
 # Update EBICS constants file using latest external code sets files
 
+import os
 import polars as pl
 import requests
-from io import BytesIO
+from pathlib import Path
+from requests.adapters import HTTPAdapter
 from zipfile import ZipFile
 
+# Shared session so that every fetch reuses pooled connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# Local copy of the code sets zip, revalidated against the server ETag
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "libeufin"
+ZIP_PATH = CACHE_DIR / "ExternalCodeSets_XLSX.zip"
+ETAG_PATH = CACHE_DIR / "ExternalCodeSets_XLSX.etag"
+
+# Code sets to generate as (code set name, kotlin class name)
+CODE_SETS = [
+    ("ExternalStatusReason1Code", "ExternalStatusReasonCode"),
+    ("ExternalPaymentGroupStatus1Code", "ExternalPaymentGroupStatusCode"),
+    ("ExternalPaymentTransactionStatus1Code", "ExternalPaymentTransactionStatusCode"),
+    ("ExternalReturnReason1Code", "ExternalReturnReasonCode"),
+]
+
 
 def iso20022codegen():
-    # Get XLSX zip file from server
-    r = requests.get(
-        "https://www.iso20022.org/sites/default/files/media/file/ExternalCodeSets_XLSX.zip"
+    # Get XLSX zip file from server, unless our cached copy is still current
+    headers = {}
+    if ZIP_PATH.exists() and ETAG_PATH.exists():
+        headers["If-None-Match"] = ETAG_PATH.read_text()
+    r = _SESSION.get(
+        "https://www.iso20022.org/sites/default/files/media/file/ExternalCodeSets_XLSX.zip",
+        headers=headers,
+        stream=True,
+        timeout=30,
     )
-    assert r.status_code == 200
+    if r.status_code == 200:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = ZIP_PATH.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for chunk in r.iter_content(chunk_size=65536):
+                f.write(chunk)
+        tmp.replace(ZIP_PATH)
+        etag = r.headers.get("ETag")
+        if etag is not None:
+            ETAG_PATH.write_text(etag)
+        else:
+            ETAG_PATH.unlink(missing_ok=True)
+    else:
+        assert r.status_code == 304
 
     # Unzip the XLSX file
-    zip = ZipFile(BytesIO(r.content))
+    zip = ZipFile(ZIP_PATH)
     files = zip.namelist()
     assert len(files) == 1
     file = zip.open(files[0])
 
     # Parse excel
-    df = pl.read_excel(file, sheet_name="AllCodeSets")
-
-    def extractCodeSet(setName: str, className: str) -> str:
-        out = f"enum class {className}(val isoCode: String, val description: String) {{"
-
-        for row in df.filter(pl.col("Code Set") == setName).sort("Code Value").rows(named=True):
-            (value, isoCode, description) = (
-                row["Code Value"],
-                row["Code Name"],
-                row["Code Definition"].split("\n", 1)[0].strip(),
-            )
-            out += f'\n\t{value}("{isoCode}", "{description}"),'
+    lf = pl.read_excel(file, sheet_name="AllCodeSets").lazy()
+
+    # Bucket the wanted code sets in a single filter pass, formatting
+    # each enum entry as a kotlin line
+    wanted = [setName for (setName, _) in CODE_SETS]
+    sub = (
+        lf.filter(pl.col("Code Set").is_in(wanted))
+        .sort("Code Value")
+        .select(
+            pl.col("Code Set"),
+            pl.format(
+                '\t{}("{}", "{}"),\n',
+                pl.col("Code Value"),
+                pl.col("Code Name"),
+                pl.col("Code Definition").str.split("\n").list.first().str.strip_chars(),
+            ).alias("line"),
+        )
+        .collect()
+    )
+    codeSets = {
+        group["Code Set"][0]: group
+        for group in sub.partition_by("Code Set", maintain_order=True)
+    }
 
-        out += "\n}"
-        return out
+    def extractCodeSet(out, setName: str, className: str):
+        out.write(f"enum class {className}(val isoCode: String, val description: String) {{\n")
+        out.write("".join(codeSets[setName]["line"].to_list()))
+        out.write("}\n\n")
 
     # Write kotlin file
-    kt = f"""/*
+    header = """/*
  * This file is part of LibEuFin.
  * Copyright (C) 2024 Taler Systems S.A.
 
@@ -60,16 +111,10 @@ def iso20022codegen():
 
 package tech.libeufin.nexus
 
-{extractCodeSet("ExternalStatusReason1Code", "ExternalStatusReasonCode")}
-
-{extractCodeSet("ExternalPaymentGroupStatus1Code", "ExternalPaymentGroupStatusCode")}
-
-{extractCodeSet("ExternalPaymentTransactionStatus1Code", "ExternalPaymentTransactionStatusCode")}
-
-{extractCodeSet("ExternalReturnReason1Code", "ExternalReturnReasonCode")}
-
 """
     with open("src/main/kotlin/tech/libeufin/nexus/Iso20022CodeSets.kt", "w") as file1:
-        file1.write(kt)
+        file1.write(header)
+        for (setName, className) in CODE_SETS:
+            extractCodeSet(file1, setName, className)
 
 iso20022codegen()
@@ -93,13 +93,10 @@ enum class EbicsReturnCode(val code: String) {
     }
 
     companion object {
+        private val byCode = entries.associateBy { it.code }
+
         fun lookup(code: String): EbicsReturnCode {
-            for (x in entries) {
-                if (x.code == code) {
-                    return x
-                }
-            }
-            throw Exception(
+            return byCode[code] ?: throw Exception(
                 "Unknown EBICS status code: $code"
             )
         }